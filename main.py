@@ -3,15 +3,26 @@ import threading
 import os
 import time
 import glob
+import queue
+import shutil
+import argparse
+from functools import lru_cache
+from multiprocessing.managers import BaseManager
 from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
-from itertools import product
+from fractions import Fraction
+from itertools import chain, zip_longest
+
+try:
+    import av  # PyAV, optional, used by join_videos_pyav
+except ImportError:
+    av = None
 
 """
 Since it's a Cartesian product between 2 input video sets, there are many readings/decodings per video and the goal is to
 reduce the decoding costs by creating intermediate files with low decoding footprint. However, this increases the storage 
 usage. The assumption here is that processing power and video pipeline performance is of higher priority.
 There 2 video processing pipelines:
-- One is for massive video transformation (transform_video) of input videos, left and right, to corresponding intermediate 
+- One is for massive video transformation (transform_videos) of input videos, left and right, to corresponding intermediate 
 left/right folders that contains intermediate left/right videos with video codecs that are much less expensive for 
 decoding than original.
 This pipeline requires 'expensive' decoding of original video but it happens only once per video.
@@ -31,120 +42,636 @@ the first host (video transform producer), intermediate videos are written to th
 In this improvised producer-consumer pipeline, consumer (video-combiner-encoder) doesn't have to wait for all videos to 
 be transformed first before start consume/combine them.
 But if we still want for some reason to start the second (combiner) pipeline only after the first pipeline (decoder)
-completely finishes this can be simply done by adjusting the indentations for ThreadPoolExecutor in this solution. 
+completely finishes this can be simply done by emitting join tasks after waiting for decoder futures instead of from
+transform_videos.
 """
 
-# Max number of concurrent ffmpeg processes
-MAX_CONCURRENT_DEC_PROCESSES = 30
-MAX_CONCURRENT_ENC_PROCESSES = 30
+# Max number of concurrent ffmpeg processes, fewer of them run when their threads wouldn't fit the cpus (see
+# ffmpeg_thread_budget)
+MAX_CONCURRENT_DEC_PROCESSES = os.cpu_count()
+MAX_CONCURRENT_ENC_PROCESSES = os.cpu_count()
 MAX_ENC_TIME = 10800  # e.g. 3h
+# Number of input videos transformed by a single ffmpeg process
+TRANSFORM_BATCH_SIZE = 8
+# Number of video combinations written by a single ffmpeg process, they all share one decoding of the same video
+JOIN_BATCH_SIZE = 8
+# Crop and hstack run in one ffmpeg graph reading original videos directly, without intermediate files. On a single
+# host with fast disks this saves writing and reading intermediates and their storage, see module docstring
+FUSED_MODE = False
+# Split intermediate files into segments of SEGMENT_TIME seconds (None - one intermediate file per video). Every FFV1
+# frame is a key frame (-g 1) so segments are cut exactly, each segment can be read on its own for random access to
+# sub-ranges of a video or by distributed workers, join stage reads the whole video through its ffconcat list
+SEGMENT_TIME = None
+
+CROP_FILTERS = {'left': 'crop=iw/2:ih:0:0', 'right': 'crop=iw/2:ih:iw/2:0'}
+
+# Join videos in-process through PyAV (libav bindings) instead of spawning an ffmpeg process per join batch.
+# Requires 'pip install av'. Resulting video combinations have no audio in this mode
+USE_PYAV = False
+# Distributed mode: the producer host runs the transformation stage and puts join jobs to a bounded job queue served
+# over TCP, worker hosts take jobs from it and combine the intermediate files. Intermediate and output folders have to
+# be shared between hosts (NFS/SMB mount) under the same paths. The job queue unpickles whatever an authenticated peer
+# sends, so the producer and workers share a secret authkey (--authkey or JOB_QUEUE_AUTHKEY environment variable,
+# there is no default) and the producer listens on localhost unless a bind address is given
+JOB_QUEUE_PORT = 50000
+JOB_QUEUE_MAX_LENGTH = 100  # producer's decoders wait when workers fall behind
+# Max number of concurrent NVENC sessions supported by the GPU (driver limit on consumer cards)
+NVENC_MAX_SESSIONS = 8
+
+# Encoders for resulting video combinations in order of preference, first one that works on this host is used.
+# The join stage is a trivial hstack so hardware encoders take over the most expensive part of it. Decoding and hstack
+# stay on CPU since FFV1 intermediates can't be decoded by NVDEC and hstack has no CUDA filter
+VIDEO_ENCODERS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p1', '-tune', 'll'],
+    'h264_qsv': ['-c:v', 'h264_qsv', '-preset', 'veryfast'],
+    'libx264': ['-c:v', 'libx264', '-preset', 'ultrafast'],
+}
+
+# Processor utilization of 2 different video processing pipelines is controlled by the number of ffmpeg processes
+# running at the same time and the number of threads per ffmpeg process. Throughput is best when
+# concurrent processes * threads per process ~ cpu cores, with 2-4 threads per video. One ffmpeg process handles a
+# whole batch of videos, each of them with its own decoder and encoder, so a process needs batch size * FFMPEG_THREADS
+# threads
+FFMPEG_THREADS = 4
+# Pin transformation and join ffmpeg processes to disjoint halves of the available cpus so that 2 pipelines don't
+# compete for the same cores and caches. Requires taskset (Linux), otherwise processes run on all cpus
+CPU_AFFINITY = True
+
+available_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+if FUSED_MODE or len(available_cpus) < 2:
+    dec_cpus = enc_cpus = available_cpus
+else:
+    dec_cpus = available_cpus[:len(available_cpus) // 2]
+    enc_cpus = available_cpus[len(available_cpus) // 2:]
+
+
+def ffmpeg_thread_budget(cpus, batch_size, max_processes):
+    # number of concurrent ffmpeg processes on cpus (at most max_processes) and threads per decoder and per encoder of
+    # each video in a batch. Decoder and encoder of a video share its FFMPEG_THREADS threads. If a single process needs
+    # more threads than there are cpus, threads per video are reduced so that one process still fits (at least one
+    # thread per stream)
+    threads_per_video = max(1, min(FFMPEG_THREADS, len(cpus) // batch_size))
+    processes = max(1, min(max_processes, len(cpus) // (batch_size * threads_per_video)))
+    return processes, max(1, threads_per_video // 2)
+
 
-# ad-hoc trivial approach to control processor utilization of 2 different video processing pipelines
-# for example, tuned values obtained after few manual tries to keep cpu utilization <70%
-INTER_DEC_TIME = 0.5  # decoding thread pause time after finishing its decoding and writing to intermediate files
-INTER_ENC_TIME = 0.5  # encoding thread pause time after finishing its encoding and writing to resulting video combination
+def cpu_affinity_prefix(cpus):
+    # taskset sets the affinity before ffmpeg starts, so all of its threads inherit it
+    if not CPU_AFFINITY or cpus == available_cpus or shutil.which('taskset') is None:
+        return []
+    return ['taskset', '-c', ','.join(map(str, cpus))]
 
-left_videos = glob.glob("left_dir/video*.mp4")
-right_videos = glob.glob("right_dir/video*.mp4")
 
-transformed_left = set()
-transformed_right = set()
-all_video_combinations = set()
+def init_transform_cpus(cpus):
+    global dec_processes, dec_stream_threads, dec_sem, dec_cmd_prefix
+    dec_processes, dec_stream_threads = ffmpeg_thread_budget(cpus, TRANSFORM_BATCH_SIZE, MAX_CONCURRENT_DEC_PROCESSES)
+    dec_sem = threading.BoundedSemaphore(dec_processes)
+    dec_cmd_prefix = cpu_affinity_prefix(cpus)
+
+
+def init_join_cpus(cpus, batch_size=JOIN_BATCH_SIZE, max_processes=MAX_CONCURRENT_ENC_PROCESSES):
+    # join stage of a new run, enc_sem starts without slots and gets them from set_join_cpus
+    global enc_sem, enc_processes
+    enc_sem, enc_processes = threading.Semaphore(0), 0
+    set_join_cpus(cpus, batch_size, max_processes)
+
+
+def set_join_cpus(cpus, batch_size=JOIN_BATCH_SIZE, max_processes=MAX_CONCURRENT_ENC_PROCESSES):
+    # cpus of join processes started from now on, enc_sem gets a slot for each additional process. The split between
+    # the stages only matters while they overlap, once all videos are transformed joins get all cpus
+    global enc_processes, enc_stream_threads, enc_cmd_prefix
+    processes, enc_stream_threads = ffmpeg_thread_budget(cpus, batch_size, max_processes)
+    enc_cmd_prefix = cpu_affinity_prefix(cpus)
+    if processes > enc_processes:
+        enc_sem.release(processes - enc_processes)
+        enc_processes = processes
+
+
+# pools of both stages have as many threads as processes allowed by their semaphores, a pool thread never waits for a
+# semaphore while its task counts as running (except join tasks waiting for the cpus of the transformation stage)
+init_transform_cpus(dec_cpus)
+init_join_cpus(enc_cpus)
+
+# input options placed before each '-i' to skip ffmpeg's default stream analysis (up to 5s per input), stream
+# parameters of mp4 originals and mkv intermediates are known from their headers. '-fflags nobuffer' is not used, it's
+# meant for live streams and drops the packets read during probing, which for files are the first frames
+FAST_PROBE_ARGS = ['-probesize', '32', '-analyzeduration', '0']
+
+
+def detect_video_encoder():
+    # an encoder listed by 'ffmpeg -encoders' is only compiled in, a short test encode checks that the hw is present
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        available_encoders = result.stdout.decode()
+        for encoder, encoder_args in VIDEO_ENCODERS.items():
+            if encoder not in available_encoders:
+                continue
+            cmd = [
+                'ffmpeg', '-hide_banner',
+                '-f', 'lavfi', '-i', 'testsrc=size=256x256:duration=0.1',
+                *encoder_args, '-f', 'null', '-',
+            ]
+            if subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                return encoder
+    except Exception as e:
+        print(f"Exception video encoder detection: {e}")
+    return 'libx264'
+
+
+# state of one main() run, set (and reset) by main() so that it can be called again in the same process
+video_encoder = 'libx264'  # from detect_video_encoder()
+join_batch_size = JOIN_BATCH_SIZE  # JOIN_BATCH_SIZE limited by NVENC_MAX_SESSIONS when NVENC is used
+
+# append-only list of (side, (path, stem)) of transformed videos from both sides in order of their completion.
+# list.append and slicing are atomic, so decoder threads add and read it without locks (a deque can't be used since
+# iterating it while another thread appends raises RuntimeError)
+transformed_videos = []
 
 # Directory for output files
 output_left_dir = "transformed_left_videos"
 output_right_dir = "transformed_right_videos"
 final_output_dir = "video_output"
-os.makedirs(output_left_dir, exist_ok=True)
-os.makedirs(output_right_dir, exist_ok=True)
+# directory prefixes (with trailing separator) joined once, file paths are then built by plain string concatenation
+output_dir_prefixes = {'left': os.path.join(output_left_dir, ""), 'right': os.path.join(output_right_dir, "")}
+final_output_prefix = os.path.join(final_output_dir, "")
+
+# long-lived encoder pool created by main(), join tasks are submitted to it as soon as both intermediate files of
+# pairs exist
+encode_pool = None
+start_enc_time = None
+# join tasks submitted to encode_pool and not finished yet, at most twice the encode_pool threads of them since
+# submitting more waits on pending_joins until some of them finish
+enc_futures = set()
+lock_enc_futures = threading.Lock()
+pending_joins = None
+# in distributed mode join jobs go to this queue instead of encode_pool
+job_queue = None
+
+
+class JobQueueManager(BaseManager):
+    pass
+
+
+def get_job_queue():
+    return job_queue
+
+
+JobQueueManager.register('get_job_queue', callable=get_job_queue)
+
+
+def find_segments(output_prefix, stem):
+    return sorted(glob.glob(f"{glob.escape(output_prefix + stem)}_[0-9][0-9][0-9][0-9].mkv"))
+
+
+def remove_segments(output_prefix, stem):
+    for segment in find_segments(output_prefix, stem):
+        os.remove(segment)
+
 
-lock_transformed_left = threading.Lock()
-lock_transformed_right = threading.Lock()
+def write_segment_list(list_file, output_prefix, stem):
+    # ffconcat list of video segments, paths are relative to the list file
+    with open(list_file, 'w') as f:
+        f.write("ffconcat version 1.0\n")
+        for segment in find_segments(output_prefix, stem):
+            escaped_name = os.path.basename(segment).replace("'", "'\\''")
+            f.write(f"file '{escaped_name}'\n")
 
 
-def transform_video(input_file, lock, side="left"):
-    global transformed_left
-    global transformed_right
-    crop = 'crop=iw/2:ih:0:0' if side == 'left' else 'crop=iw/2:ih:iw/2:0'
-    output_dir = output_left_dir if side == 'left' else output_right_dir
-    output_file = os.path.join(output_dir, f"{os.path.basename(input_file)}")
+def enc_time_exceeded():
+    # worker hosts don't know the producer's start time, the producer drops its queued jobs after MAX_ENC_TIME
+    return start_enc_time is not None and time.time() - start_enc_time > MAX_ENC_TIME
+
+
+def submit_join(fixed_file, other_files, fixed_side="left"):
+    # no new video combinations are started after MAX_ENC_TIME. Waiting for a free slot is bounded by the remaining
+    # time and the deadline is checked again once the slot is taken, since it may have passed while waiting
+    remaining_enc_time = MAX_ENC_TIME - (time.time() - start_enc_time)
+    if remaining_enc_time <= 0:
+        return
+    if job_queue is not None:
+        try:
+            # blocks while the queue is full
+            job_queue.put((fixed_file, other_files, fixed_side), timeout=remaining_enc_time)
+        except queue.Full:
+            pass
+    else:
+        if not pending_joins.acquire(timeout=remaining_enc_time):
+            return
+        if enc_time_exceeded():
+            pending_joins.release()
+            return
+        future = encode_pool.submit(run_join_task, fixed_file, other_files, fixed_side)
+        with lock_enc_futures:
+            enc_futures.add(future)
+        future.add_done_callback(join_finished)
+
+
+def join_finished(future):
+    with lock_enc_futures:
+        enc_futures.discard(future)
+    pending_joins.release()
+
+
+def transform_videos(input_files, side="left"):
+    crop = CROP_FILTERS[side]
+    output_prefix = output_dir_prefixes[side]
+    # stems are computed once per video and carried with the intermediate paths, (path, stem) tuples are what
+    # transformed_videos holds and what join_videos gets
+    stems = [os.path.splitext(os.path.basename(input_file))[0] for input_file in input_files]
+    output_files = [(f"{output_prefix}{stem}{'.ffconcat' if SEGMENT_TIME else '.mkv'}", stem) for stem in stems]
     try:
-        # convert original video to an intra frame decoding video so that expensive decoding happens only once per
-        # each input video
-        cmd = [
-            'ffmpeg',
-            '-i', input_file,
-            '-vf', crop,  # Crop left or right
-            '-c:v', 'png', '-pix_fmt', 'rgb24', '-y',
-            output_file,
-        ]
-        print(f"Starting video transformation {input_file}")
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        time.sleep(INTER_DEC_TIME)
+        # convert original videos to intra frame decoding videos so that expensive decoding happens only once per
+        # each input video. One ffmpeg process handles the whole batch (N inputs -> N outputs) so that process
+        # creation and ffmpeg initialization are paid once per batch instead of once per video
+        cmd = [*dec_cmd_prefix, 'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostats', '-y']
+        for input_file in input_files:
+            cmd += [*FAST_PROBE_ARGS, '-threads', str(dec_stream_threads), '-i', input_file]
+        for i, (output_file, stem) in enumerate(output_files):
+            cmd += [
+                '-map', f'{i}:v:0', '-map', f'{i}:a:0?',
+                '-vf', crop,  # Crop left or right
+                # FFV1 all-intra (-g 1) with slices decodes several times faster than PNG and skips zlib on encode
+                '-c:v', 'ffv1', '-level', '3', '-g', '1', '-slices', '16', '-slicecrc', '0',
+                '-pix_fmt', 'yuv420p',  # same pix_fmt on both sides for hstack
+                '-threads', str(dec_stream_threads),
+            ]
+            if SEGMENT_TIME:
+                remove_segments(output_prefix, stem)  # left from a previous run with a longer video
+                cmd += ['-f', 'segment', '-segment_time', str(SEGMENT_TIME), '-reset_timestamps', '1',
+                        f"{output_prefix}{stem}_%04d.mkv"]
+            else:
+                cmd += [output_file]
+        print(f"Starting video transformation {input_files}")
+        with dec_sem:
+            # only errors are written to stderr, it's decoded only when ffmpeg fails
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         if result.returncode != 0:
-            print(f"Error video transformation {input_file}: {result.stderr.decode()}")
-        else:
-            print(f"Finished video transformation {input_file}")
-            with lock:
-                if side == "left":
-                    transformed_left.add(output_file)
-                else:
-                    transformed_right.add(output_file)
+            print(f"Error video transformation {input_files}: {result.stderr.decode()}")
+            if len(input_files) > 1:
+                # one corrupt or missing input fails the whole batch, its videos are transformed again one by one so
+                # that only the bad video and its combinations are lost
+                print(f"Retrying video transformation {input_files} one video at a time")
+                for input_file in input_files:
+                    transform_videos([input_file], side)
+            return
+        print(f"Finished video transformation {input_files}")
+        if SEGMENT_TIME:
+            for output_file, stem in output_files:
+                write_segment_list(output_file, output_prefix, stem)
+        for output_file in output_files:
+            # each new intermediate file emits its join tasks with the files of the other side that are before it
+            # in transformed_videos, files appended after it emit their own pairs with this one. Positions in an
+            # append-only list never change, so every pair is emitted exactly once without locks and without
+            # keeping track of already emitted pairs
+            entry = (side, output_file)
+            transformed_videos.append(entry)
+            earlier_videos = transformed_videos[:transformed_videos.index(entry)]
+            other_files = [other_file for other_side, other_file in earlier_videos if other_side != side]
+            # one join task (one ffmpeg process) combines the new file with up to join_batch_size other files,
+            # submit_join waits while there are too many pending join tasks
+            for i in range(0, len(other_files), join_batch_size):
+                submit_join(output_file, other_files[i:i + join_batch_size], side)
     except Exception as e:
-        print(f"Exception video transformation {input_file}: {e}")
+        print(f"Exception video transformation {input_files}: {e}")
+
+
+def join_output_files(fixed_stem, other_files, fixed_side="left"):
+    # resulting video combination is named <left stem>_<right stem>.mp4
+    if fixed_side == "left":
+        return [f"{final_output_prefix}{fixed_stem}_{other_stem}.mp4" for _, other_stem in other_files]
+    return [f"{final_output_prefix}{other_stem}_{fixed_stem}.mp4" for _, other_stem in other_files]
 
 
-def join_videos(input_file_left, input_file_right):
-    output_basename = f"{os.path.basename(input_file_left)[:-4]}" + f"_{os.path.basename(input_file_right)}"
-    output_file = os.path.join(final_output_dir, output_basename)
+@lru_cache(maxsize=None)
+def join_filter_graph(k, fixed_side="left", fused=False):
+    # concat frames from 2 videos into one frame in resulting video. The fixed video (input 0) is decoded only once per
+    # batch and its frames are split to one hstack per other video (inputs 1..k), hstack outputs are [o0]..[o{k-1}].
+    # Batches of the same size and side share the same graph, so it's built only once
+    other_side = "right" if fixed_side == "left" else "left"
+    # in fused mode original videos are cropped in the same graph, format keeps the same pix_fmt for hstack
+    fixed_crop = f"{CROP_FILTERS[fixed_side]},format=yuv420p," if fused else ""
+    filters = [f"[0:v]{fixed_crop}split={k}" + "".join(f"[f{i}]" for i in range(k))]
+    for i in range(k):
+        other_pad = f"[{i + 1}:v]"
+        if fused:
+            filters.append(f"{other_pad}{CROP_FILTERS[other_side]},format=yuv420p[c{i}]")
+            other_pad = f"[c{i}]"
+        stack_inputs = f"[f{i}]{other_pad}" if fixed_side == "left" else f"{other_pad}[f{i}]"
+        filters.append(f"{stack_inputs}hstack=inputs=2[o{i}]")
+    return ';'.join(filters)
+
+
+def join_videos(fixed_file, other_files, fixed_side="left"):
+    # fixed_file is combined with every file from other_files, fixed_side tells on which side of the output frame it is.
+    # Files are (path, stem) tuples of intermediate files or, in FUSED_MODE, of original videos
+    fixed_path, fixed_stem = fixed_file
+    output_files = join_output_files(fixed_stem, other_files, fixed_side)
     try:
-        # concat frames from 2 videos into one frame in resulting video
-        cmd = [
-            'ffmpeg',
-            '-i', input_file_left,
-            '-i', input_file_right,
-            '-filter_complex', 'hstack=inputs=2', '-y',
-            output_file,
-        ]
-        print(f"Writing to {output_file}")
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        time.sleep(INTER_ENC_TIME)
+        # intermediate files are always FFV1 in matroska (or ffconcat lists of segments), forcing the demuxer skips
+        # container probing
+        if FUSED_MODE:
+            input_args = FAST_PROBE_ARGS
+        elif SEGMENT_TIME:
+            input_args = [*FAST_PROBE_ARGS, '-f', 'concat', '-safe', '0']
+        else:
+            input_args = [*FAST_PROBE_ARGS, '-f', 'matroska']
+        input_args = [*input_args, '-threads', str(enc_stream_threads)]
+        cmd = [*enc_cmd_prefix, 'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostats', '-y',
+               *input_args, '-i', fixed_path]
+        for other_path, _ in other_files:
+            cmd += [*input_args, '-i', other_path]
+        cmd += ['-filter_complex', join_filter_graph(len(other_files), fixed_side, FUSED_MODE),
+                '-filter_complex_threads', str(enc_stream_threads)]
+        for i, output_file in enumerate(output_files):
+            left_input = 0 if fixed_side == "left" else i + 1
+            cmd += ['-map', f'[o{i}]', '-map', f'{left_input}:a:0?', *VIDEO_ENCODERS[video_encoder],
+                    '-threads', str(enc_stream_threads), output_file]
+        print(f"Writing to {output_files}")
+        # only errors are written to stderr, it's decoded only when ffmpeg fails
+        result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         if result.returncode != 0:
-            print(f"Error writing to {output_file}: {result.stderr.decode()}")
+            print(f"Error writing to {output_files}: {result.stderr.decode()}")
         else:
-            print(f"Finished writing to {output_file}")
+            print(f"Finished writing to {output_files}")
     except Exception as e:
-        print(f"Exception writing to {output_file}: {e}")
+        print(f"Exception writing to {output_files}: {e}")
 
 
-"""
-Using ThreadPoolExecutor to schedule video transformation tasks
-Transform left and right videos to intermediate video files, once per each video. 
-Intermediate video files require much less expensive decoding for repeating reading/decoding to create all possible
-video combinations
-"""
-# Transform left
-with ThreadPoolExecutor(max_workers=int(MAX_CONCURRENT_DEC_PROCESSES / 2)) as executor:
-    futures_left = [executor.submit(transform_video, vf, lock_transformed_left) for vf in left_videos]
-
-    # Transform right
-    with ThreadPoolExecutor(max_workers=int(MAX_CONCURRENT_DEC_PROCESSES / 2)) as executor:
-        futures_right = [executor.submit(transform_video, vf, lock_transformed_right, "right") for vf in right_videos]
-
-        start_enc_time = time.time()
-        # merge left and right videos and make all video combinations
-        total_outputs_number = len(left_videos) * len(right_videos)
-        while len(all_video_combinations) < total_outputs_number or time.time() - start_enc_time > MAX_ENC_TIME:
-            # lock transformed_left and transformed_right to create all available combination at a given moment if we want to
-            # start creating of final video output combinations from intermediate files before all these files are created by
-            # overlapping video transformation and video combination tasks. However, the benefit of this approach is questionable,
-            # for example, on a single host, comparing with complete-transformation-then-complete-processing approach
-            with lock_transformed_left:
-                with lock_transformed_right:
-                    prepared_combinations = set(product(transformed_left, transformed_right))
-                    print(prepared_combinations)
-            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_ENC_PROCESSES) as executor:
-                futures = [executor.submit(join_videos, vt[0], vt[1]) for vt in prepared_combinations]
-                done, not_done = wait(futures, return_when=ALL_COMPLETED)
-                all_video_combinations = all_video_combinations | prepared_combinations
-                prepared_combinations.clear()
+def join_videos_pyav(fixed_file, other_files, fixed_side="left"):
+    # same as join_videos but libav runs in this process, frames of the fixed video are decoded once and pushed to one
+    # filter graph (buffer, buffer -> hstack -> buffersink) per other video. Each output ends with its shorter input
+    fixed_path, fixed_stem = fixed_file
+    other_side = "right" if fixed_side == "left" else "left"
+    output_files = join_output_files(fixed_stem, other_files, fixed_side)
+    encoder_args = VIDEO_ENCODERS[video_encoder]
+    encoder_options = {option.lstrip('-'): value for option, value in zip(encoder_args[2::2], encoder_args[3::2])}
+    # segmented intermediate files are read through their ffconcat lists
+    open_args = {'format': 'concat', 'options': {'safe': '0'}} if SEGMENT_TIME and not FUSED_MODE else {}
+    containers = []
+    try:
+        fixed_container = av.open(fixed_path, **open_args)
+        containers.append(fixed_container)
+        fixed_stream = fixed_container.streams.video[0]
+        fixed_stream.thread_type = "AUTO"
+        fixed_stream.codec_context.thread_count = enc_stream_threads
+        time_base = 1 / Fraction(fixed_stream.average_rate or 25)
+        outputs = []
+        for (other_path, _), output_file in zip(other_files, output_files):
+            other_container = av.open(other_path, **open_args)
+            containers.append(other_container)
+            other_stream = other_container.streams.video[0]
+            other_stream.thread_type = "AUTO"
+            other_stream.codec_context.thread_count = enc_stream_threads
+            graph = av.filter.Graph()
+            fixed_src = graph.add_buffer(template=fixed_stream)
+            other_src = graph.add_buffer(template=other_stream)
+            stack_inputs = {fixed_side: fixed_src, other_side: other_src}
+            if FUSED_MODE:
+                # original videos are cropped in the same graph, format keeps the same pix_fmt for hstack
+                for side, src in stack_inputs.items():
+                    crop = graph.add(*CROP_FILTERS[side].split('=', 1))
+                    pix_fmt = graph.add('format', 'yuv420p')
+                    src.link_to(crop)
+                    crop.link_to(pix_fmt)
+                    stack_inputs[side] = pix_fmt
+            hstack = graph.add('hstack', 'inputs=2')
+            stack_inputs['left'].link_to(hstack, 0, 0)
+            stack_inputs['right'].link_to(hstack, 0, 1)
+            sink = graph.add('buffersink')
+            hstack.link_to(sink)
+            graph.configure()
+            output_container = av.open(output_file, 'w')
+            containers.append(output_container)
+            output_stream = output_container.add_stream(video_encoder, rate=fixed_stream.average_rate or 25)
+            output_stream.options = encoder_options
+            output_stream.codec_context.time_base = time_base
+            output_stream.codec_context.thread_count = enc_stream_threads
+            # graph is kept referenced, its filter contexts don't keep it alive
+            outputs.append([other_container.decode(other_stream), graph, fixed_src, other_src, sink, output_container,
+                            output_stream, 0])
+        print(f"Writing to {output_files}")
+        for fixed_frame in fixed_container.decode(fixed_stream):
+            for output in outputs:
+                other_frames, _, fixed_src, other_src, sink, output_container, output_stream, frame_index = output
+                if other_frames is None:
+                    continue
+                other_frame = next(other_frames, None)
+                if other_frame is None:
+                    output[0] = None
+                    continue
+                fixed_src.push(fixed_frame)
+                other_src.push(other_frame)
+                try:
+                    frame = sink.pull()
+                except BlockingIOError:
+                    continue
+                if frame_index == 0:
+                    output_stream.width, output_stream.height = frame.width, frame.height
+                    output_stream.pix_fmt = frame.format.name
+                frame.pts, frame.time_base = frame_index, time_base
+                output_container.mux(output_stream.encode(frame))
+                output[7] = frame_index + 1
+        for _, _, _, _, _, output_container, output_stream, frame_index in outputs:
+            if frame_index > 0:
+                output_container.mux(output_stream.encode(None))
+        print(f"Finished writing to {output_files}")
+    except Exception as e:
+        print(f"Exception writing to {output_files}: {e}")
+    finally:
+        for container in containers:
+            container.close()
+
+
+join_task = join_videos_pyav if USE_PYAV and av is not None else join_videos
+
+
+def run_join_task(fixed_file, other_files, fixed_side="left"):
+    # join tasks wait for enc_sem when more of them are running than join processes are allowed, MAX_ENC_TIME is
+    # checked again once a task can start, so that tasks waiting here don't start writing after the deadline
+    with enc_sem:
+        if enc_time_exceeded():
+            print(f"MAX_ENC_TIME exceeded, skipping {join_output_files(fixed_file[1], other_files, fixed_side)}")
+            return
+        join_task(fixed_file, other_files, fixed_side)
+
+
+def main(left_pattern="left_dir/video*.mp4", right_pattern="right_dir/video*.mp4", distributed=False, authkey=None,
+         bind_address="localhost"):
+    """
+    Using ThreadPoolExecutor to schedule video transformation tasks
+    Transform left and right videos to intermediate video files, once per each video.
+    Intermediate video files require much less expensive decoding for repeating reading/decoding to create all possible
+    video combinations
+    Input videos are selected by glob patterns, so that one run can process a shard of the input sets
+    In distributed mode this host is only the producer, join jobs are served to worker hosts (see run_worker) on
+    bind_address, workers have to use the same authkey
+    """
+    if distributed and not authkey:
+        raise ValueError("distributed mode requires an authkey")
+    global video_encoder, join_batch_size, encode_pool, start_enc_time, pending_joins, job_queue
+    global transformed_videos, enc_futures
+    # nothing is carried over from a previous run in the same process, e.g. its transformed videos would be paired
+    # with the new ones
+    transformed_videos = []
+    enc_futures = set()
+    encode_pool = pending_joins = job_queue = None
+    video_encoder = 'libx264'
+    join_batch_size = JOIN_BATCH_SIZE
+    max_enc_processes = MAX_CONCURRENT_ENC_PROCESSES
+    if not distributed:
+        video_encoder = detect_video_encoder()
+        print(f"Using video encoder {video_encoder}")
+        if video_encoder == 'h264_nvenc':
+            # each output of a join batch opens its own NVENC session
+            join_batch_size = min(JOIN_BATCH_SIZE, NVENC_MAX_SESSIONS)
+            max_enc_processes = max(1, NVENC_MAX_SESSIONS // join_batch_size)
+
+    # outputs of a transformation batch are published only when its longest video is done, so videos are batched in
+    # order of their size. Videos of similar length share a batch and the shortest ones are transformed first, so
+    # that joining can start early
+    left_videos = sorted(glob.glob(left_pattern), key=os.path.getsize)
+    right_videos = sorted(glob.glob(right_pattern), key=os.path.getsize)
+
+    os.makedirs(output_left_dir, exist_ok=True)
+    os.makedirs(output_right_dir, exist_ok=True)
+    os.makedirs(final_output_dir, exist_ok=True)
+
+    # the producer host runs no joins, transformations can use all of its cpus
+    init_transform_cpus(available_cpus if distributed else dec_cpus)
+    init_join_cpus(enc_cpus, join_batch_size, max_enc_processes)
+    if distributed:
+        job_queue = queue.Queue(maxsize=JOB_QUEUE_MAX_LENGTH)
+        server = JobQueueManager(address=(bind_address, JOB_QUEUE_PORT), authkey=authkey).get_server()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving join jobs on {bind_address}:{JOB_QUEUE_PORT}")
+    else:
+        # enough threads for the join processes on all cpus after the transformation stage, until then the extra ones
+        # wait for enc_sem
+        pool_size, _ = ffmpeg_thread_budget(available_cpus, join_batch_size, max_enc_processes)
+        encode_pool = ThreadPoolExecutor(max_workers=pool_size)
+        pending_joins = threading.BoundedSemaphore(pool_size * 2)
+    start_enc_time = time.time()
+
+    if FUSED_MODE:
+        # no transformation stage, all video combinations are known upfront and each left video is decoded once per
+        # batch of join_batch_size right videos. Batches are generated lazily, submit_join waits for free slots
+        left_files = [(vf, os.path.splitext(os.path.basename(vf))[0]) for vf in left_videos]
+        right_files = [(vf, os.path.splitext(os.path.basename(vf))[0]) for vf in right_videos]
+        for left_file in left_files:
+            for i in range(0, len(right_files), join_batch_size):
+                submit_join(left_file, right_files[i:i + join_batch_size])
+    else:
+        # one decoder pool for both sides. Left and right batches are submitted in turns so that first intermediate
+        # files of both sets become available early and joining can start
+        decode_pool = ThreadPoolExecutor(max_workers=dec_processes)
+        left_batches = [(left_videos[i:i + TRANSFORM_BATCH_SIZE], "left")
+                        for i in range(0, len(left_videos), TRANSFORM_BATCH_SIZE)]
+        right_batches = [(right_videos[i:i + TRANSFORM_BATCH_SIZE], "right")
+                         for i in range(0, len(right_videos), TRANSFORM_BATCH_SIZE)]
+        dec_futures = [decode_pool.submit(transform_videos, *batch)
+                       for batch in chain.from_iterable(zip_longest(left_batches, right_batches)) if batch is not None]
+
+        # join tasks are emitted by transform_videos while transformation is still running, so video combinations
+        # are created as soon as first intermediate files from both sets become available. Once all decoders are
+        # done no new join tasks can appear and it's enough to wait for the already submitted ones
+        wait(dec_futures, return_when=ALL_COMPLETED)
+        decode_pool.shutdown(wait=True)
+        if not distributed:
+            set_join_cpus(available_cpus, join_batch_size, max_enc_processes)
+
+    if distributed:
+        # workers mark every job done, once all are done the producer exits and workers lose the connection. The wait
+        # is bounded by MAX_ENC_TIME like in local mode, so a worker that died with a job it took doesn't keep the
+        # producer waiting forever
+        remaining_enc_time = max(0, MAX_ENC_TIME - (time.time() - start_enc_time))
+        with job_queue.all_tasks_done:
+            all_done = job_queue.all_tasks_done.wait_for(lambda: not job_queue.unfinished_tasks,
+                                                         timeout=remaining_enc_time)
+        if not all_done:
+            # jobs that are still queued are dropped, workers finish the ones they already took
+            dropped_jobs = 0
+            while True:
+                try:
+                    job_queue.get_nowait()
+                except queue.Empty:
+                    break
+                job_queue.task_done()
+                dropped_jobs += 1
+            print(f"MAX_ENC_TIME exceeded, dropping {dropped_jobs} queued video combinations, "
+                  f"{job_queue.unfinished_tasks} unfinished")
+        return
+    with lock_enc_futures:
+        pending_enc_futures = list(enc_futures)
+    remaining_enc_time = max(0, MAX_ENC_TIME - (time.time() - start_enc_time))
+    done, not_done = wait(pending_enc_futures, timeout=remaining_enc_time, return_when=ALL_COMPLETED)
+    if not_done:
+        print(f"MAX_ENC_TIME exceeded, cancelling {len(not_done)} pending video combinations")
+    # combinations that are already being written are finished, the queued ones are dropped
+    encode_pool.shutdown(wait=True, cancel_futures=True)
+
+
+def run_worker(producer_host, authkey):
+    """
+    Consumer (video-combiner-encoder) for distributed mode, takes join jobs from the producer's job queue and combines
+    intermediate files read from the shared folders until the producer finishes
+    """
+    if not authkey:
+        raise ValueError("worker requires the producer's authkey")
+    global video_encoder
+    video_encoder = detect_video_encoder()
+    print(f"Using video encoder {video_encoder}")
+    max_processes = MAX_CONCURRENT_ENC_PROCESSES
+    if video_encoder == 'h264_nvenc':
+        # join batches come from the producer, sessions are shared by all batches running on this host
+        max_processes = max(1, NVENC_MAX_SESSIONS // JOIN_BATCH_SIZE)
+    # nothing is transformed on a worker host, join processes can use all cpus. There is one consumer per join process,
+    # a job is taken from the producer only when it can start right away, so that jobs this host can't run yet stay
+    # in the queue for other workers
+    init_join_cpus(available_cpus, JOIN_BATCH_SIZE, max_processes)
+    max_workers = enc_processes
+    os.makedirs(final_output_dir, exist_ok=True)
+
+    manager = JobQueueManager(address=(producer_host, JOB_QUEUE_PORT), authkey=authkey)
+    manager.connect()
+    jobs = manager.get_job_queue()
+
+    def consume_jobs():
+        while True:
+            try:
+                job = jobs.get()
+            except (EOFError, OSError):
+                return
+            run_join_task(*job)
+            try:
+                jobs.task_done()
+            except (EOFError, OSError):
+                return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in range(max_workers):
+            executor.submit(consume_jobs)
+    print("Producer finished, worker exits")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Combine left and right video sets into all video combinations")
+    parser.add_argument('mode', nargs='?', choices=['local', 'produce', 'work'], default='local',
+                        help="local: both pipelines on this host, produce: transform and serve join jobs, "
+                             "work: take join jobs from the producer")
+    parser.add_argument('--left', default="left_dir/video*.mp4", help="glob pattern of left videos")
+    parser.add_argument('--right', default="right_dir/video*.mp4", help="glob pattern of right videos")
+    parser.add_argument('--producer', default="localhost", help="producer host, used in work mode")
+    parser.add_argument('--bind', default="localhost",
+                        help="address the producer listens on for workers, used in produce mode")
+    parser.add_argument('--authkey', default=os.environ.get('JOB_QUEUE_AUTHKEY'),
+                        help="secret shared by the producer and workers (default: JOB_QUEUE_AUTHKEY environment "
+                             "variable), required in produce and work modes")
+    args = parser.parse_args()
+    if args.mode != 'local' and not args.authkey:
+        parser.error("produce and work modes require --authkey or the JOB_QUEUE_AUTHKEY environment variable")
+    authkey = args.authkey.encode() if args.authkey else None
+    if args.mode == 'work':
+        run_worker(args.producer, authkey)
+    else:
+        main(args.left, args.right, distributed=args.mode == 'produce', authkey=authkey, bind_address=args.bind)